@@ -1,12 +1,15 @@
 """Tools for collaborative reasoning between Tiled, RPGJS, and Pydantic agents."""
 from typing import Dict, Any, Optional, List
+from functools import lru_cache
+import asyncio
+import hashlib
 import logging
 import httpx
-import json
-from datetime import datetime
+import orjson
 import os
+import uuid
 from dotenv import load_dotenv
-from httpx import RequestError, HTTPError, TimeoutException
+from httpx import RequestError, HTTPStatusError, TimeoutException
 
 load_dotenv()
 
@@ -16,6 +19,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=256)
+def _format_query(template: str, user_input: str) -> str:
+    """Format a query template, memoized since orchestration repeats inputs."""
+    return template.format(user_input=f"User input: {user_input}" if user_input else "")
+
+def _encode_context(context: Optional[Dict]) -> Optional[str]:
+    """Encode request context as a JSON string.
+
+    The agent APIs take ``context`` as a string, so the dict is sent as
+    JSON, which the receiving agent can parse back, rather than as its
+    Python repr.
+    """
+    return orjson.dumps(context).decode() if context else None
+
 class AgentCommunication:
     """Enables collaborative problem-solving between Railway agents."""
     
@@ -40,34 +57,60 @@ class AgentCommunication:
             "Content-Type": "application/json",
             "Accept": "application/json"
         }
-        logger.debug(f"Using RPGJS API URL: {self.rpgjs_api_url}")
-        logger.debug(f"Using Pydantic API URL: {self.pydantic_api_url}")
+        # Shared HTTP/2 client so concurrent calls to a host multiplex over
+        # one reused connection
+        self._client = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+        )
+        logger.debug("Using RPGJS API URL: %s", self.rpgjs_api_url)
+        logger.debug("Using Pydantic API URL: %s", self.pydantic_api_url)
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP client and its pooled connections."""
+        await self._client.aclose()
+
+    async def __aenter__(self) -> "AgentCommunication":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
 
     async def _retry_request(
         self, 
-        client: httpx.AsyncClient, 
         method: str, 
         url: str, 
         **kwargs
     ) -> httpx.Response:
-        """Retry HTTP requests with exponential backoff."""
+        """Retry HTTP requests with exponential backoff.
+
+        Timeouts, connection errors and 5xx responses are retried; 4xx
+        responses are raised immediately.
+        """
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                logger.debug(f"Attempt {attempt + 1} for {method} {url}")
-                response = await client.request(method, url, **kwargs)
+                logger.debug("Attempt %d for %s %s", attempt + 1, method, url)
+                response = await self._client.request(method, url, **kwargs)
                 response.raise_for_status()
                 return response
             except TimeoutException as te:
-                logger.warning(f"Timeout on attempt {attempt+1} for {url}: {te}")
+                logger.warning("Timeout on attempt %d for %s: %s", attempt + 1, url, te)
                 if attempt == max_retries - 1:
                     raise
-            except HTTPError as he:
-                logger.error(f"HTTP error for {url}: {he}")
-                raise
+            except HTTPStatusError as he:
+                if he.response.status_code < 500 or attempt == max_retries - 1:
+                    logger.error("HTTP error for %s: %s", url, he)
+                    raise
+                logger.warning("Server error on attempt %d for %s: %s", attempt + 1, url, he)
             except RequestError as re:
-                logger.error(f"Request error for {url}: {re}")
-                raise
+                if attempt == max_retries - 1:
+                    logger.error("Request error for %s: %s", url, re)
+                    raise
+                logger.warning("Request error on attempt %d for %s: %s", attempt + 1, url, re)
+            await asyncio.sleep(min(2 ** attempt * 0.5, 8.0))
         raise RuntimeError(f"Failed after {max_retries} attempts")
 
     # Query templates for different agent types
@@ -112,53 +155,63 @@ class AgentCommunication:
         )
     }
 
+    # Query types issued during collaborative map design
+    RPGJS_QUERY_TYPES = ("npc_behavior", "environmental_factors")
+    PYDANTIC_QUERY_TYPES = ("npc_schema", "map_validation")
+
     def get_rpgjs_query(self, query_type: str, user_input: str = "") -> str:
         """Get a formatted RPGJS query template."""
         template = self.RPGJS_QUERY_TEMPLATES.get(query_type)
         if not template:
-            logger.warning(f"Unknown RPGJS query type: {query_type}")
+            logger.warning("Unknown RPGJS query type: %s", query_type)
             return user_input
-        return template.format(user_input=f"User input: {user_input}" if user_input else "")
+        return _format_query(template, user_input)
 
     def get_pydantic_query(self, query_type: str, user_input: str = "") -> str:
         """Get a formatted Pydantic query template."""
         template = self.PYDANTIC_QUERY_TEMPLATES.get(query_type)
         if not template:
-            logger.warning(f"Unknown Pydantic query type: {query_type}")
+            logger.warning("Unknown Pydantic query type: %s", query_type)
             return user_input
-        return template.format(user_input=f"User input: {user_input}" if user_input else "")
+        return _format_query(template, user_input)
+
+    # Aspects assigned to each agent when a request mentions AI-driven NPCs
+    _AI_NPC_KEYWORDS = ("ai", "npc")
+    _AI_NPC_TILED_ASPECTS = (
+        "environmental_factors",
+        "event_triggers",
+        "object_placement",
+        "custom_properties"
+    )
+    _AI_NPC_RPGJS_ASPECTS = (
+        "npc_behavior",
+        "event_handling",
+        "ai_integration"
+    )
+    _AI_NPC_PYDANTIC_ASPECTS = (
+        "npc_schema",
+        "behavior_models",
+        "environmental_rules"
+    )
 
-    async def analyze_request(self, user_request: str) -> Dict[str, List[str]]:
+    def analyze_request(self, user_request: str) -> Dict[str, List[str]]:
         """Break down a complex user request into components for each agent."""
-        logger.info(f"Analyzing request: {user_request[:100]}...")
-        aspects: Dict[str, List[str]] = {
+        logger.info("Analyzing request: %.100s...", user_request)
+        lowered = user_request.lower()
+        if all(keyword in lowered for keyword in self._AI_NPC_KEYWORDS):
+            logger.debug("Found AI-NPC related aspects in request")
+            return {
+                "tiled_aspects": list(self._AI_NPC_TILED_ASPECTS),
+                "rpgjs_aspects": list(self._AI_NPC_RPGJS_ASPECTS),
+                "pydantic_aspects": list(self._AI_NPC_PYDANTIC_ASPECTS)
+            }
+
+        logger.info("Request does not contain AI-NPC keywords")
+        return {
             "tiled_aspects": [],
             "rpgjs_aspects": [],
             "pydantic_aspects": []
         }
-        
-        if "ai" in user_request.lower() and "npc" in user_request.lower():
-            aspects["tiled_aspects"].extend([
-                "environmental_factors",
-                "event_triggers",
-                "object_placement",
-                "custom_properties"
-            ])
-            aspects["rpgjs_aspects"].extend([
-                "npc_behavior",
-                "event_handling",
-                "ai_integration"
-            ])
-            aspects["pydantic_aspects"].extend([
-                "npc_schema",
-                "behavior_models",
-                "environmental_rules"
-            ])
-            logger.debug("Found AI-NPC related aspects in request")
-        else:
-            logger.info("Request does not contain AI-NPC keywords")
-        
-        return aspects
 
     async def ask_rpgjs_agent(self, query: str, context: Optional[Dict] = None) -> Dict[str, Any]:
         """Query the RPGJS agent with context-aware questions."""
@@ -167,23 +220,20 @@ class AgentCommunication:
         payload = {
             "query": query,
             "user_id": "tiled_agent",
-            "session_id": str(int(datetime.now().timestamp())),
-            "context": str(context) if context else None
+            # Random, so ids never repeat across instances, workers or restarts
+            "session_id": uuid.uuid4().hex,
+            "context": _encode_context(context)
         }
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await self._retry_request(
-                    client,
-                    "POST",
-                    endpoint,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=30.0
-                )
-                return response.json()
+            response = await self._retry_request(
+                "POST",
+                endpoint,
+                content=orjson.dumps(payload)
+            )
+            return response.json()
         except Exception as e:
-            logger.error(f"Failed to communicate with RPGJS agent: {e}")
+            logger.error("Failed to communicate with RPGJS agent: %s", e)
             return {
                 "error": str(e),
                 "message": "Failed to communicate with RPGJS agent"
@@ -196,62 +246,137 @@ class AgentCommunication:
         payload = {
             "query": query,
             "user_id": "tiled_agent",
-            "session_id": str(int(datetime.now().timestamp())),
-            "context": str(context) if context else None
+            # Random, so ids never repeat across instances, workers or restarts
+            "session_id": uuid.uuid4().hex,
+            "context": _encode_context(context)
         }
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await self._retry_request(
-                    client,
-                    "POST",
-                    endpoint,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=30.0
-                )
-                return response.json()["response"] if "response" in response.json() else response.json()
+            response = await self._retry_request(
+                "POST",
+                endpoint,
+                content=orjson.dumps(payload)
+            )
+            data = response.json()
+            return data["response"] if "response" in data else data
         except Exception as e:
-            logger.error(f"Failed to communicate with Pydantic agent: {e}")
+            logger.error("Failed to communicate with Pydantic agent: %s", e)
             return {
                 "error": str(e),
                 "message": "Failed to communicate with Pydantic agent"
             }
     
-    async def collaborative_map_design(self, user_request: str) -> Dict[str, Any]:
-        """Coordinate between agents to design a map meeting complex requirements."""
+    async def _gather_rpgjs_insights(
+        self,
+        user_request: str,
+        context: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Issue every RPGJS query concurrently, keyed by query type."""
+        results = await asyncio.gather(*(
+            self.ask_rpgjs_agent(
+                self.get_rpgjs_query(query_type, user_request),
+                context=context
+            )
+            for query_type in self.RPGJS_QUERY_TYPES
+        ))
+        return dict(zip(self.RPGJS_QUERY_TYPES, results))
+
+    async def _gather_pydantic_insights(
+        self,
+        user_request: str,
+        context: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Issue every Pydantic query concurrently, keyed by query type."""
+        results = await asyncio.gather(*(
+            self.ask_pydantic_agent(
+                self.get_pydantic_query(query_type, user_request),
+                context=context
+            )
+            for query_type in self.PYDANTIC_QUERY_TYPES
+        ))
+        return dict(zip(self.PYDANTIC_QUERY_TYPES, results))
+
+    # Longest excerpt of each RPGJS answer forwarded to the Pydantic agent
+    _RPGJS_EXCERPT_CHARS = 1500
+    # Most headings of each RPGJS answer forwarded to the Pydantic agent
+    _RPGJS_MAX_HEADINGS = 20
+
+    @classmethod
+    def _markdown_headings(cls, text: str) -> List[str]:
+        """Return the first markdown headings in text, skipping fenced code."""
+        headings: List[str] = []
+        in_code = False
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith("```"):
+                in_code = not in_code
+            elif not in_code and line.startswith("#"):
+                headings.append(line)
+                if len(headings) == cls._RPGJS_MAX_HEADINGS:
+                    break
+        return headings
+
+    def _summarize_rpgjs(self, rpgjs_responses: Dict[str, Any]) -> Dict[str, Any]:
+        """Condense RPGJS answers before forwarding them to the Pydantic agent.
+
+        Each answer is reduced to its first markdown headings, a bounded
+        excerpt and a SHA-1 of the full text; callers still get the full
+        answers.
+        """
+        summary: Dict[str, Any] = {}
+        for query_type, data in rpgjs_responses.items():
+            if isinstance(data, dict) and "error" in data:
+                summary[query_type] = {"error": data["error"]}
+                continue
+
+            text = data.get("response", data) if isinstance(data, dict) else data
+            if not isinstance(text, str):
+                text = orjson.dumps(text).decode()
+            summary[query_type] = {
+                "sha1": hashlib.sha1(text.encode()).hexdigest(),
+                "headings": self._markdown_headings(text),
+                "excerpt": text[:self._RPGJS_EXCERPT_CHARS]
+            }
+        return summary
+
+    async def collaborative_map_design(
+        self,
+        user_request: str,
+        parallel_independent: bool = False
+    ) -> Dict[str, Any]:
+        """Coordinate between agents to design a map meeting complex requirements.
+
+        By default the Pydantic agent receives a summary of the RPGJS answers
+        as ``rpgjs_requirements``, so its queries wait for the RPGJS ones.
+        Pass ``parallel_independent=True`` to drop that field and issue all
+        queries at once; latency becomes the slowest single call instead of
+        the slowest RPGJS call plus the slowest Pydantic call.
+        """
         logger.info("Starting collaborative map design process")
-        aspects = await self.analyze_request(user_request)
+        aspects = self.analyze_request(user_request)
 
-        # Get RPGJS insights
-        rpgjs_responses: Dict[str, Any] = {}
         rpgjs_context = {
             "request_type": "map_design",
             "aspects": aspects["rpgjs_aspects"],
             "original_request": user_request
         }
-
-        for query_type in ["npc_behavior", "environmental_factors"]:
-            query = self.get_rpgjs_query(query_type, user_request)
-            rpgjs_responses[query_type] = await self.ask_rpgjs_agent(
-                query, 
-                context=rpgjs_context
-            )
-
-        # Get Pydantic insights
-        pydantic_responses: Dict[str, Any] = {}
-        pydantic_context = {
+        pydantic_context: Dict[str, Any] = {
             "request_type": "npc_modeling",
             "aspects": aspects["pydantic_aspects"],
-            "rpgjs_requirements": rpgjs_responses,
             "original_request": user_request
         }
 
-        for query_type in ["npc_schema", "map_validation"]:
-            query = self.get_pydantic_query(query_type, user_request)
-            pydantic_responses[query_type] = await self.ask_pydantic_agent(
-                query, 
-                context=pydantic_context
+        if parallel_independent:
+            rpgjs_responses, pydantic_responses = await asyncio.gather(
+                self._gather_rpgjs_insights(user_request, rpgjs_context),
+                self._gather_pydantic_insights(user_request, pydantic_context)
+            )
+        else:
+            rpgjs_responses = await self._gather_rpgjs_insights(user_request, rpgjs_context)
+            pydantic_context["rpgjs_requirements"] = self._summarize_rpgjs(rpgjs_responses)
+            pydantic_responses = await self._gather_pydantic_insights(
+                user_request,
+                pydantic_context
             )
 
         logger.info("Synthesizing map design recommendations")
@@ -259,131 +384,111 @@ class AgentCommunication:
             "analysis": aspects,
             "rpgjs_insights": rpgjs_responses,
             "pydantic_insights": pydantic_responses,
-            "map_recommendations": {
-                "layers": self._derive_layer_structure(rpgjs_responses, pydantic_responses),
-                "properties": self._derive_custom_properties(rpgjs_responses, pydantic_responses),
-                "events": self._derive_event_structure(rpgjs_responses, pydantic_responses)
-            }
+            "map_recommendations": self._map_recommendations()
         }
-    
-    def _derive_layer_structure(
-        self,
-        rpgjs_data: Dict[str, Any],
-        pydantic_data: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
-        """Derive optimal layer structure based on agent responses."""
-        logger.debug("Deriving layer structure from agent responses")
-        
-        # Base layer structure
-        layers: List[Dict[str, Any]] = [
-            {
-                "name": "Ground",
-                "type": "tilelayer",
-                "properties": {}
-            },
-            {
-                "name": "Environment",
-                "type": "tilelayer",
-                "properties": {
-                    "affects_npc_behavior": True
-                }
-            },
-            {
-                "name": "NPCs",
-                "type": "objectgroup",
-                "properties": {
-                    "ai_controlled": True
-                }
-            },
-            {
-                "name": "Events",
-                "type": "objectgroup",
-                "properties": {
-                    "event_type": "ai_trigger"
-                }
-            }
-        ]
 
-        # Validate layer names
-        layer_names = {layer["name"] for layer in layers}
-        if len(layer_names) != len(layers):
-            logger.warning("Duplicate layer names detected in layer structure")
+    @staticmethod
+    def _map_recommendations() -> Dict[str, List[Dict[str, Any]]]:
+        """Build the base map structures for one response.
 
-        return layers
-
-    def _derive_custom_properties(
-        self,
-        rpgjs_data: Dict[str, Any],
-        pydantic_data: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
-        """Derive custom properties based on agent responses."""
-        logger.debug("Deriving custom properties from agent responses")
-        
-        # Base properties structure
-        properties: List[Dict[str, Any]] = [
-            {
-                "name": "environmental_factor",
-                "type": "string",
-                "values": ["peaceful", "hostile", "neutral"]
-            },
-            {
-                "name": "npc_behavior_zone",
-                "type": "string",
-                "values": ["patrol", "guard", "wander", "interact"]
-            },
-            {
-                "name": "interaction_type",
-                "type": "string",
-                "values": ["quest", "shop", "dialogue", "battle"]
-            }
-        ]
-
-        # Validate property names
-        property_names = {prop["name"] for prop in properties}
-        if len(property_names) != len(properties):
-            logger.warning("Duplicate property names detected in custom properties")
-
-        return properties
-
-    def _derive_event_structure(
-        self,
-        rpgjs_data: Dict[str, Any],
-        pydantic_data: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
-        """Derive event structure based on agent responses."""
-        logger.debug("Deriving event structure from agent responses")
-        
-        # Base event structure
-        events: List[Dict[str, Any]] = [
-            {
-                "type": "npc_spawn",
-                "properties": {
-                    "ai_type": "string",
-                    "behavior_params": "json",
-                    "interaction_radius": "number"
+        Built from literals on every call, so each caller gets its own
+        structures and changing one result can't alter another.
+        """
+        return {
+            "layers": [
+                {
+                    "name": "Ground",
+                    "type": "tilelayer",
+                    "properties": {}
+                },
+                {
+                    "name": "Environment",
+                    "type": "tilelayer",
+                    "properties": {
+                        "affects_npc_behavior": True
+                    }
+                },
+                {
+                    "name": "NPCs",
+                    "type": "objectgroup",
+                    "properties": {
+                        "ai_controlled": True
+                    }
+                },
+                {
+                    "name": "Events",
+                    "type": "objectgroup",
+                    "properties": {
+                        "event_type": "ai_trigger"
+                    }
                 }
-            },
-            {
-                "type": "environment_trigger",
-                "properties": {
-                    "effect": "string",
-                    "duration": "number",
-                    "radius": "number"
+            ],
+            "properties": [
+                {
+                    "name": "environmental_factor",
+                    "type": "string",
+                    "values": ["peaceful", "hostile", "neutral"]
+                },
+                {
+                    "name": "npc_behavior_zone",
+                    "type": "string",
+                    "values": ["patrol", "guard", "wander", "interact"]
+                },
+                {
+                    "name": "interaction_type",
+                    "type": "string",
+                    "values": ["quest", "shop", "dialogue", "battle"]
                 }
-            },
-            {
-                "type": "behavior_modifier",
-                "properties": {
-                    "modifier_type": "string",
-                    "strength": "number",
-                    "conditions": "json"
+            ],
+            "events": [
+                {
+                    "type": "npc_spawn",
+                    "properties": {
+                        "ai_type": "string",
+                        "behavior_params": "json",
+                        "interaction_radius": "number"
+                    }
+                },
+                {
+                    "type": "environment_trigger",
+                    "properties": {
+                        "effect": "string",
+                        "duration": "number",
+                        "radius": "number"
+                    }
+                },
+                {
+                    "type": "behavior_modifier",
+                    "properties": {
+                        "modifier_type": "string",
+                        "strength": "number",
+                        "conditions": "json"
+                    }
                 }
-            }
-        ]
+            ]
+        }
+
 
-        # Validate event types
-        event_types = {event["type"] for event in events}
-        if len(event_types) != len(events):
-            logger.warning("Duplicate event types detected in event structure")
+def _warn_on_duplicates(items: List[Dict[str, Any]], key: str, message: str) -> None:
+    """Log ``message`` if any two items share the same ``key`` value."""
+    if len({item[key] for item in items}) != len(items):
+        logger.warning(message)
 
-        return events
+
+# The base structures are constant, so validate them once at import time
+_BASE_MAP = AgentCommunication._map_recommendations()
+_warn_on_duplicates(
+    _BASE_MAP["layers"],
+    "name",
+    "Duplicate layer names detected in layer structure"
+)
+_warn_on_duplicates(
+    _BASE_MAP["properties"],
+    "name",
+    "Duplicate property names detected in custom properties"
+)
+_warn_on_duplicates(
+    _BASE_MAP["events"],
+    "type",
+    "Duplicate event types detected in event structure"
+)
@@ -0,0 +1,27 @@
+from typing import Any, Dict, List
+
+import orjson
+from openai import AsyncOpenAI
+
+
+async def batch_answers(client: AsyncOpenAI, batch: Any) -> List[Dict[str, Any]]:
+    """Read a completed batch's output file, one answer per submitted query.
+
+    Output lines come back in any order, so each is placed by its
+    custom_id, the query's index. Each answer is {"response": ...} or
+    {"error": ...}.
+    """
+    output = await client.files.content(batch.output_file_id)
+    answers = {}
+    for line in output.content.splitlines():
+        item = orjson.loads(line)
+        body = (item.get("response") or {}).get("body") or {}
+        answers[int(item["custom_id"])] = (
+            {"response": body["choices"][0]["message"]["content"]} if "choices" in body
+            else {"error": item.get("error") or body.get("error")}
+        )
+    # Failed requests go to the batch's error file instead
+    return [
+        answers.get(index, {"error": "Request failed"})
+        for index in range(batch.request_counts.total)
+    ]
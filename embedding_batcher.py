@@ -0,0 +1,87 @@
+import asyncio
+from typing import List, Optional, Set, Tuple
+
+from openai import AsyncOpenAI, BadRequestError
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into batched API calls.
+
+    submit() queues a text and waits for its embedding. A background task
+    waits max_wait seconds after the first queued text, takes up to
+    max_batch texts and embeds them with one embeddings.create call, so K
+    concurrent requests cost one round-trip instead of K.
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        model: str,
+        dimensions: int,
+        max_batch: int = 32,
+        max_wait: float = 0.008
+    ):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # Created on first use, inside the serving event loop
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batches: Set[asyncio.Task] = set()
+
+    async def submit(self, text: str) -> List[float]:
+        """Embed a single text as part of the next batch."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            # Give concurrent requests a moment to join this batch
+            await asyncio.sleep(self.max_wait)
+            while len(items) < self.max_batch and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            # Embed in the background so the next batch can start collecting
+            batch = asyncio.create_task(self._embed(items))
+            self._batches.add(batch)
+            batch.add_done_callback(self._batches.discard)
+
+    async def _embed(self, items: List[Tuple[str, asyncio.Future]]):
+        try:
+            response = await self.client.embeddings.create(
+                model=self.model,
+                input=[text for text, _ in items],
+                dimensions=self.dimensions
+            )
+        except BadRequestError as e:
+            # One bad input (empty, too long) fails the whole list; retry each
+            # text alone so only its own caller sees the error. Any other
+            # error (auth, rate limit, server) would fail every text anyway.
+            if len(items) > 1:
+                await asyncio.gather(*(self._embed([item]) for item in items))
+            else:
+                self._fail(items, e)
+            return
+        except Exception as e:
+            self._fail(items, e)
+            return
+        for item in response.data:
+            if item.index < len(items):
+                _, future = items[item.index]
+                # Skip requests that were cancelled while waiting
+                if not future.done():
+                    future.set_result(item.embedding)
+        # Never leave a caller waiting on an embedding the API didn't return
+        self._fail(items, RuntimeError("Embedding missing from API response"))
+
+    @staticmethod
+    def _fail(items: List[Tuple[str, asyncio.Future]], error: Exception):
+        for _, future in items:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,71 @@
+import re
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterator, List
+
+
+def iter_chunks(
+    text: str,
+    encoding: Any,
+    target_tokens: int = 512,
+    overlap: int = 64
+) -> Iterator[str]:
+    """Split text lazily into chunks of about target_tokens tokens.
+
+    Chunks end at a code block boundary if possible, otherwise at a paragraph
+    or sentence break, and consecutive chunks share up to overlap tokens.
+    encoding is a tiktoken Encoding, or anything with the same encode() and
+    decode_with_offsets() methods.
+    """
+    # Encode once; chunks are sliced from text via each token's start offset
+    tokens = encoding.encode(text, disallowed_special=())
+    if not tokens:
+        return
+    _, starts = encoding.decode_with_offsets(tokens)
+    starts.append(len(text))
+    token_count = len(tokens)
+
+    # Token indices to cut at, found in one pass per break type (lookaheads
+    # keep overlapping matches); sentence cuts fall just after the period
+    def cuts(pattern: str, shift: int = 0) -> List[int]:
+        return sorted({
+            bisect_right(starts, m.start() + shift) - 1
+            for m in re.finditer(pattern, text)
+        })
+
+    # Paragraph cuts go to the first token starting after the blank line:
+    # tokenizers join trailing newlines to the punctuation before them
+    # ('.\n\n' is one token), so cutting at the token holding the first
+    # newline would split a sentence from its closing period
+    paragraph_cuts = sorted({
+        bisect_left(starts, m.end())
+        for m in re.finditer(r'\n\n+', text)
+    })
+
+    break_cuts = (cuts(r'(?=```)'), paragraph_cuts, cuts(r'\. ', 1))
+
+    start = 0
+    while start < token_count:
+        end = start + target_tokens
+
+        # If we're at the end of the text, just take what's left
+        if end >= token_count:
+            chunk = text[starts[start]:].strip()
+            if chunk:
+                yield chunk
+            break
+
+        # Prefer a code block boundary, then a paragraph, then a sentence,
+        # but only past 30% of the window
+        min_end = start + target_tokens * 0.3
+        for marks in break_cuts:
+            i = bisect_right(marks, end) - 1
+            if i >= 0 and marks[i] > min_end:
+                end = marks[i]
+                break
+
+        chunk = text[starts[start]:starts[end]].strip()
+        if chunk:
+            yield chunk
+
+        # Step back by the overlap, always making progress
+        start = max(start + 1, end - overlap)
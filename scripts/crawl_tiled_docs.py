@@ -1,29 +1,68 @@
 import os
+import re
 import sys
 import json
 import asyncio
+import hashlib
+import httpx
 import requests
 from xml.etree import ElementTree
-from typing import List, Dict, Any
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, urlsplit, urlunsplit
 from dotenv import load_dotenv
 from bs4 import BeautifulSoup
 
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
 from openai import AsyncOpenAI
 from supabase import create_client, Client
+import tiktoken
+
+from chunking import iter_chunks
 
 load_dotenv()
 
 # Initialize OpenAI and Supabase clients
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=5,  # SDK backs off exponentially on 429s, 5xx and connection errors
+    timeout=60.0,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+)
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"),
     os.getenv("SUPABASE_SERVICE_KEY")
 )
 
+# Embedding settings; must match the vector column in supabase/setup.sql
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# Tokenizer for the embedding model; loading it is slow, so do it once
+ENCODING = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+# Cheap model for chunk titles and summaries; separate from the API's
+# LLM_MODEL so neither setting changes the other
+TITLE_MODEL = os.getenv("TITLE_MODEL", "gpt-4o-mini")
+
+# Cap in-flight requests to OpenAI and Supabase across all documents
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "8")))
+DB_SEM = asyncio.Semaphore(int(os.getenv("DB_CONCURRENCY", "4")))
+
+# LLM results keyed by content hash, so identical chunks reached through
+# different URLs are only sent to OpenAI once
+title_cache: Dict[str, Dict[str, str]] = {}
+embedding_cache: Dict[str, List[float]] = {}
+
+def content_hash(text: str) -> str:
+    """Return a short, stable hash of a chunk's content."""
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
 @dataclass
 class ProcessedChunk:
     url: str
@@ -34,99 +73,124 @@ class ProcessedChunk:
     metadata: Dict[str, Any]
     embedding: List[float]
 
-def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
-    """Split text into chunks, respecting code blocks and paragraphs."""
-    chunks = []
-    start = 0
-    text_length = len(text)
-
-    while start < text_length:
-        # Calculate end position
-        end = start + chunk_size
-
-        # If we're at the end of the text, just take what's left
-        if end >= text_length:
-            chunks.append(text[start:].strip())
-            break
-
-        # Try to find a code block boundary first (```)
-        chunk = text[start:end]
-        code_block = chunk.rfind('```')
-        if code_block != -1 and code_block > chunk_size * 0.3:
-            end = start + code_block
-
-        # If no code block, try to break at a paragraph
-        elif '\n\n' in chunk:
-            # Find the last paragraph break
-            last_break = chunk.rfind('\n\n')
-            if last_break > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_break
-
-        # If no paragraph break, try to break at a sentence
-        elif '. ' in chunk:
-            # Find the last sentence break
-            last_period = chunk.rfind('. ')
-            if last_period > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_period + 1
-
-        # Extract chunk and clean it up
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-
-        # Move start position for next chunk
-        start = max(start + 1, end)
-
-    return chunks
-
-async def get_title_and_summary(chunk: str, url: str) -> Dict[str, str]:
-    """Extract title and summary using GPT-4."""
+def extract_title_local(chunk: str) -> Optional[str]:
+    """Return the text of the first markdown heading in a chunk, if any."""
+    # Lines starting with '#' inside code blocks are comments, not headings;
+    # a fence left open at the end of the chunk runs to its end
+    prose = re.sub(r'```.*?(?:```|\Z)', '', chunk, flags=re.S)
+    match = re.search(r'^#{1,6}[ \t]+(.+)$', prose, re.M)
+    return match.group(1).strip() if match else None
+
+def extract_summary_local(chunk: str, max_chars: int = 200) -> str:
+    """Return the first prose paragraph of a chunk, truncated to max_chars."""
+    for paragraph in chunk.split('\n\n'):
+        paragraph = paragraph.strip()
+        if paragraph and not paragraph.startswith(('#', '```')):
+            return paragraph if len(paragraph) <= max_chars else paragraph[:max_chars].rstrip() + "..."
+    return ""
+
+async def get_titles_and_summaries_llm(chunks: List[str], url: str) -> Optional[List[Dict[str, str]]]:
+    """Extract titles and summaries for several chunks with a single chat completion.
+
+    Returns None if the request fails or the reply doesn't match the chunks.
+    """
     system_prompt = """You are an AI that extracts titles and summaries from documentation chunks.
-    Return a JSON object with 'title' and 'summary' keys.
+    You will receive numbered chunks from the same page.
+    Return a JSON object with a 'chunks' key: an array with one object per chunk, in the order given, each with 'title' and 'summary' keys.
     For the title: If this seems like the start of a document, extract its title. If it's a middle chunk, derive a descriptive title.
     For the summary: Create a concise summary of the main points in this chunk.
     Keep both title and summary concise but informative."""
     
+    # Send first 1000 chars of each chunk for context
+    content = "\n\n".join(
+        f"Chunk {n}:\n{chunk[:1000]}..." for n, chunk in enumerate(chunks, 1)
+    )
     try:
-        response = await openai_client.chat.completions.create(
-            model=os.getenv("LLM_MODEL", "gpt-4"),
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"URL: {url}\n\nContent:\n{chunk[:1000]}..."}  # Send first 1000 chars for context
-            ],
-            response_format={ "type": "json_object" }
-        )
-        return json.loads(response.choices[0].message.content)
+        async with OPENAI_SEM:
+            response = await openai_client.chat.completions.create(
+                model=TITLE_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": f"URL: {url}\n\n{content}"}
+                ],
+                response_format={ "type": "json_object" }
+            )
+        extracted = json.loads(response.choices[0].message.content)["chunks"]
+        if len(extracted) != len(chunks):
+            raise ValueError(f"expected {len(chunks)} results, got {len(extracted)}")
+        return [{"title": x["title"], "summary": x["summary"]} for x in extracted]
     except Exception as e:
-        print(f"Error getting title and summary: {e}")
-        return {"title": "Error processing title", "summary": "Error processing summary"}
+        print(f"Error getting titles and summaries: {e}")
+        return None
 
-async def get_embedding(text: str) -> List[float]:
-    """Get embedding vector from OpenAI."""
-    try:
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"Error getting embedding: {e}")
-        return [0] * 1536  # Return zero vector on error
+async def get_titles_and_summaries(chunks: List[str], url: str, llm_batch_size: int = 10) -> List[Dict[str, str]]:
+    """Get a title and summary per chunk, preferring the local heuristics.
 
-async def process_chunk(chunk: str, chunk_number: int, url: str) -> ProcessedChunk:
-    """Process a single chunk of text."""
-    # Get title and summary
-    extracted = await get_title_and_summary(chunk, url)
+    Chunks without a heading or prose paragraph are sent to the LLM, up to
+    llm_batch_size chunks per request.
+    """
+    results: List[Optional[Dict[str, str]]] = [None] * len(chunks)
+    pending: List[int] = []
+    for i, chunk in enumerate(chunks):
+        title, summary = extract_title_local(chunk), extract_summary_local(chunk)
+        if title and summary:
+            results[i] = {"title": title, "summary": summary}
+        else:
+            results[i] = title_cache.get(content_hash(chunk))
+            if results[i] is None:
+                pending.append(i)
     
-    # Get embedding
-    embedding = await get_embedding(chunk)
+    batches = [pending[i:i + llm_batch_size] for i in range(0, len(pending), llm_batch_size)]
+    extracted_batches = await asyncio.gather(*[
+        get_titles_and_summaries_llm([chunks[i] for i in batch], url)
+        for batch in batches
+    ])
+    for batch, extracted in zip(batches, extracted_batches):
+        for n, i in enumerate(batch):
+            if extracted is None:
+                results[i] = {"title": "Error processing title", "summary": "Error processing summary"}
+            else:
+                results[i] = title_cache[content_hash(chunks[i])] = extracted[n]
     
+    return results
+
+async def get_embeddings_batch(texts: List[str], batch_size: int = 100) -> List[List[float]]:
+    """Get embedding vectors from OpenAI, sending up to batch_size texts per request."""
+    keys = [content_hash(text) for text in texts]
+    
+    # Only embed texts not seen before, each once
+    missing = {key: text for key, text in zip(keys, texts) if key not in embedding_cache}
+    missing_keys = list(missing)
+    for i in range(0, len(missing_keys), batch_size):
+        batch_keys = missing_keys[i:i + batch_size]
+        async with OPENAI_SEM:
+            response = await openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=[missing[key] for key in batch_keys],
+                dimensions=EMBEDDING_DIMENSIONS
+            )
+        # Results carry their input index; map them back to their keys
+        for d in response.data:
+            embedding_cache[batch_keys[d.index]] = d.embedding
+    
+    return [embedding_cache[key] for key in keys]
+
+def process_chunk(
+    chunk: str,
+    chunk_number: int,
+    url: str,
+    embedding: List[float],
+    extracted: Dict[str, str],
+    crawled_at: str,
+    url_path: str
+) -> ProcessedChunk:
+    """Process a single chunk of text."""
     # Create metadata
     metadata = {
         "source": "tiled_docs",
         "chunk_size": len(chunk),
-        "crawled_at": datetime.now(timezone.utc).isoformat(),
-        "url_path": urlparse(url).path
+        "crawled_at": crawled_at,
+        "url_path": url_path
     }
     
     return ProcessedChunk(
@@ -139,47 +203,70 @@ async def process_chunk(chunk: str, chunk_number: int, url: str) -> ProcessedChu
         embedding=embedding
     )
 
-async def insert_chunk(chunk: ProcessedChunk):
-    """Insert a processed chunk into Supabase."""
-    try:
-        data = {
-            "url": chunk.url,
-            "chunk_number": chunk.chunk_number,
-            "title": chunk.title,
-            "summary": chunk.summary,
-            "content": chunk.content,
-            "metadata": chunk.metadata,
-            "embedding": chunk.embedding
-        }
-        
-        result = supabase.table("tiled_docs").insert(data).execute()
-        print(f"Inserted chunk {chunk.chunk_number} for {chunk.url}")
-        return result
-    except Exception as e:
-        print(f"Error inserting chunk: {e}")
-        return None
+async def insert_chunks(chunks: List[ProcessedChunk], batch_size: int = 500):
+    """Insert processed chunks into Supabase, one multi-row insert per batch."""
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        try:
+            rows = [
+                {
+                    "url": chunk.url,
+                    "chunk_number": chunk.chunk_number,
+                    "title": chunk.title,
+                    "summary": chunk.summary,
+                    "content": chunk.content,
+                    "metadata": chunk.metadata,
+                    "embedding": chunk.embedding
+                }
+                for chunk in batch
+            ]
+            
+            # supabase-py is synchronous; run it in a thread so the bound is real
+            async with DB_SEM:
+                await asyncio.to_thread(supabase.table("tiled_docs").insert(rows).execute)
+            print(f"Inserted {len(rows)} chunks for {batch[0].url}")
+        except Exception as e:
+            print(f"Error inserting chunks: {e}")
 
-async def process_and_store_document(url: str, markdown: str):
-    """Process a document and store its chunks in parallel."""
-    # Split into chunks
-    chunks = chunk_text(markdown)
+async def process_and_store_document(url: str, markdown: str, batch_size: int = 64):
+    """Process a document and store its chunks, one batch of chunks at a time."""
+    # Chunks are generated lazily, so only the current batch is held in memory
+    chunks = iter_chunks(markdown, ENCODING)
+    chunk_number = 0
     
-    # Process chunks in parallel
-    tasks = [
-        process_chunk(chunk, i, url) 
-        for i, chunk in enumerate(chunks)
-    ]
-    processed_chunks = await asyncio.gather(*tasks)
+    # Shared by every chunk of the document
+    crawled_at = datetime.now(timezone.utc).isoformat()
+    url_path = urlparse(url).path
     
-    # Store chunks in parallel
-    insert_tasks = [
-        insert_chunk(chunk) 
-        for chunk in processed_chunks
-    ]
-    await asyncio.gather(*insert_tasks)
+    while batch := list(islice(chunks, batch_size)):
+        # Embed the batch and get titles/summaries (LLM only as a batched
+        # fallback) concurrently; the two are independent
+        embeddings, extracted = await asyncio.gather(
+            get_embeddings_batch(batch),
+            get_titles_and_summaries(batch, url)
+        )
+        
+        processed_chunks = [
+            process_chunk(chunk, chunk_number + i, url, embedding, titles, crawled_at, url_path)
+            for i, (chunk, embedding, titles) in enumerate(zip(batch, embeddings, extracted))
+        ]
+        
+        # Store chunks with bulk inserts
+        await insert_chunks(processed_chunks)
+        chunk_number += len(batch)
 
-async def crawl_parallel(urls: List[str], max_concurrent: int = 5):
-    """Crawl multiple URLs in parallel with a concurrency limit."""
+async def crawl_parallel(
+    urls: List[str],
+    max_concurrent: int = 5,
+    max_workers: int = 3,
+    queue_size: int = 32
+):
+    """Crawl multiple URLs in parallel with a concurrency limit.
+
+    Crawled pages are handed to a pool of max_workers processing tasks
+    through a bounded queue, so crawling isn't held up by embedding and
+    storage, and pauses only when queue_size pages are waiting.
+    """
     browser_config = BrowserConfig(
         headless=True,
         verbose=False,
@@ -191,28 +278,67 @@ async def crawl_parallel(urls: List[str], max_concurrent: int = 5):
     crawler = AsyncWebCrawler(config=browser_config)
     await crawler.start()
 
+    # Crawled (url, markdown) pairs; None tells a worker to stop
+    queue: asyncio.Queue[Optional[Tuple[str, str]]] = asyncio.Queue(maxsize=queue_size)
+
+    async def process_worker():
+        while (item := await queue.get()) is not None:
+            url, markdown = item
+            try:
+                await process_and_store_document(url, markdown)
+            except Exception as e:
+                # Raised once the OpenAI client's retries are exhausted
+                print(f"Error processing {url}: {e}")
+
     try:
         # Create a semaphore to limit concurrency
         semaphore = asyncio.Semaphore(max_concurrent)
         
         async def process_url(url: str):
             async with semaphore:
-                result = await crawler.arun(
-                    url=url,
-                    config=crawl_config,
-                    session_id="session1"
-                )
-                if result.success:
-                    print(f"Successfully crawled: {url}")
-                    await process_and_store_document(url, result.markdown_v2.raw_markdown)
-                else:
-                    print(f"Failed: {url} - Error: {result.error_message}")
+                try:
+                    result = await crawler.arun(
+                        url=url,
+                        config=crawl_config,
+                        session_id="session1"
+                    )
+                except Exception as e:
+                    print(f"Failed: {url} - Error: {e}")
+                    return
+            if result.success:
+                print(f"Successfully crawled: {url}")
+                # Waits only if the workers are queue_size pages behind
+                await queue.put((url, result.markdown_v2.raw_markdown))
+            else:
+                print(f"Failed: {url} - Error: {result.error_message}")
+        
+        workers = [asyncio.create_task(process_worker()) for _ in range(max_workers)]
         
         # Process all URLs in parallel with limited concurrency
         await asyncio.gather(*[process_url(url) for url in urls])
+        
+        # One sentinel per worker; each exits once the queue is drained
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
     finally:
         await crawler.close()
 
+def canon(url: str) -> str:
+    """Canonical form of a URL for deduplication.
+
+    Lowercases scheme and host, collapses the trailing slash and drops the
+    query and fragment, so anchors into the same page map to one URL.
+    """
+    parts = urlsplit(url)
+    return urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path.rstrip('/') or '/',
+        '',
+        ''
+    ))
+
 async def get_tiled_docs_urls() -> List[str]:
     """Get URLs focused on comprehensive API understanding and advanced Tiled features for agent-to-agent communication."""
     urls = set()
@@ -305,9 +431,9 @@ async def get_tiled_docs_urls() -> List[str]:
     ]
     
     # Add Map Editor URLs
-    urls.add(map_editor_base)
+    urls.add(canon(map_editor_base))
     for url in map_editor_urls:
-        urls.add(f"{map_editor_base}{url}")
+        urls.add(canon(f"{map_editor_base}{url}"))
     
     # Tiled Python Library documentation
     python_base = "https://tiled.readthedocs.io/en/latest/"
@@ -450,15 +576,15 @@ async def get_tiled_docs_urls() -> List[str]:
     
     # Add Python Library URLs
     for url in python_urls:
-        urls.add(f"{python_base}{url}")
+        urls.add(canon(f"{python_base}{url}"))
     
     # Add Additional Python Library URLs
     for base_url, paths in python_docs.items():
         if not paths:
-            urls.add(base_url)
+            urls.add(canon(base_url))
         else:
             for path in paths:
-                urls.add(f"{base_url}{path}")
+                urls.add(canon(f"{base_url}{path}"))
     
     print(f"Found URLs:\n" + "\n".join(sorted(urls)))
     return list(urls)
@@ -1,6 +1,6 @@
 import os
 import asyncio
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 from bs4 import BeautifulSoup
 import httpx
 from openai import AsyncOpenAI
@@ -11,83 +11,144 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Initialize clients
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=5,  # SDK backs off exponentially on 429s, 5xx and connection errors
+    timeout=60.0,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+)
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"),
     os.getenv("SUPABASE_SERVICE_KEY")
 )
 
-async def fetch_documentation(base_url: str = "https://tiled.readthedocs.io/en/latest/") -> List[Dict[str, str]]:
-    """Fetch documentation pages from Tiled's ReadTheDocs."""
-    async with httpx.AsyncClient() as client:
+# Embedding settings; must match the vector column the documents are stored in
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# Characters per stored chunk, and chunks per embedding request and insert
+CHUNK_SIZE = 1000
+EMBED_BATCH = 100
+
+def extract_main_text(html: str) -> Optional[str]:
+    """Return the text of a documentation page's main content, if present."""
+    content = BeautifulSoup(html, 'lxml').select_one('div[role=main]')
+    if not content:
+        return None
+    return content.get_text(separator='\n', strip=True)
+
+def windows(text: str, size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Yield slices covering text in size-character windows."""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+async def fetch_documentation(
+    base_url: str = "https://tiled.readthedocs.io/en/latest/",
+    max_concurrent: int = 10
+) -> List[Dict[str, str]]:
+    """Fetch the main text of documentation pages from Tiled's ReadTheDocs."""
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        timeout=30.0
+    ) as client:
         # Get the main page
         response = await client.get(base_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = await asyncio.to_thread(BeautifulSoup, response.text, 'lxml')
         
-        docs = []
-        # Find all documentation links
+        # Find all documentation links, each page once
+        urls = []
         for link in soup.find_all('a', href=True):
             href = link['href']
             if href.startswith('http'):
                 url = href
             else:
                 url = base_url.rstrip('/') + '/' + href.lstrip('/')
-            
-            try:
+            urls.append(url.split('#', 1)[0])
+        urls = list(dict.fromkeys(urls))
+        
+        semaphore = asyncio.Semaphore(max_concurrent)
+        
+        async def fetch_page(url: str) -> Optional[str]:
+            async with semaphore:
                 page_response = await client.get(url)
-                page_soup = BeautifulSoup(page_response.text, 'html.parser')
-                
-                # Get main content
-                content = page_soup.find('div', {'role': 'main'})
-                if content:
-                    text = content.get_text(separator='\n', strip=True)
-                    # Split into smaller chunks
-                    chunks = [text[i:i+1000] for i in range(0, len(text), 1000)]
-                    for chunk in chunks:
-                        docs.append({
-                            'content': chunk,
-                            'url': url
-                        })
-            except Exception as e:
-                print(f"Error fetching {url}: {str(e)}")
+            
+            # Parse off the event loop so other responses keep being read
+            return await asyncio.to_thread(extract_main_text, page_response.text)
+        
+        # Fetch pages concurrently, bounded by the semaphore
+        texts = await asyncio.gather(*[fetch_page(url) for url in urls], return_exceptions=True)
+        
+        pages = []
+        for url, text in zip(urls, texts):
+            if isinstance(text, Exception):
+                print(f"Error fetching {url}: {str(text)}")
                 continue
+            if text:
+                pages.append({'content': text, 'url': url})
                 
-        return docs
+        return pages
 
-async def get_embedding(text: str) -> List[float]:
-    """Get embedding for text using OpenAI's API."""
-    response = await openai_client.embeddings.create(
-        model="text-embedding-ada-002",
-        input=text
-    )
-    return response.data[0].embedding
+async def get_embeddings_batch(texts: List[str], batch_size: int = 100) -> List[List[float]]:
+    """Get embeddings for texts using OpenAI's API, up to batch_size texts per request."""
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        response = await openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=texts[i:i + batch_size],
+            dimensions=EMBEDDING_DIMENSIONS
+        )
+        # Results carry their input index; order by it to match the batch
+        embeddings.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+    return embeddings
 
-async def store_documents(docs: List[Dict[str, str]]):
-    """Store documents and their embeddings in Supabase."""
-    for doc in docs:
-        try:
-            embedding = await get_embedding(doc['content'])
-            
-            # Store in Supabase
-            supabase.table('documentation').insert({
-                'content': doc['content'],
-                'url': doc['url'],
+async def store_chunks(batch: List[Tuple[str, str]]):
+    """Embed a batch of (url, content) chunks and insert them in Supabase."""
+    try:
+        embeddings = await get_embeddings_batch([content for _, content in batch], EMBED_BATCH)
+    except Exception as e:
+        print(f"Error embedding documents: {str(e)}")
+        return
+    
+    try:
+        # Store the whole batch in Supabase with one insert
+        supabase.table('documentation').insert([
+            {
+                'content': content,
+                'url': url,
                 'embedding': embedding
-            }).execute()
-            
-            print(f"Stored document from {doc['url']}")
-        except Exception as e:
-            print(f"Error storing document: {str(e)}")
-            continue
+            }
+            for (url, content), embedding in zip(batch, embeddings)
+        ]).execute()
+        
+        print(f"Stored {len(batch)} documents")
+    except Exception as e:
+        print(f"Error storing documents: {str(e)}")
+
+async def store_documents(pages: List[Dict[str, str]]):
+    """Split pages into chunks and store them with their embeddings in Supabase."""
+    # Chunks are sliced lazily, so only one batch is materialized at a time
+    batch: List[Tuple[str, str]] = []
+    for page in pages:
+        for content in windows(page['content']):
+            batch.append((page['url'], content))
+            if len(batch) == EMBED_BATCH:
+                await store_chunks(batch)
+                batch = []
+    if batch:
+        await store_chunks(batch)
 
 async def main():
     """Main function to fetch and store documentation."""
     print("Fetching documentation...")
-    docs = await fetch_documentation()
-    print(f"Found {len(docs)} documentation chunks")
+    pages = await fetch_documentation()
+    print(f"Found {len(pages)} documentation pages")
     
     print("Storing documents with embeddings...")
-    await store_documents(docs)
+    await store_documents(pages)
     print("Done!")
 
 if __name__ == "__main__":
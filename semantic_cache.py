@@ -0,0 +1,58 @@
+import itertools
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """In-memory cache of answers, looked up by query embedding similarity.
+
+    Embeddings are stored as unit vectors in one preallocated float32
+    matrix, so a lookup is a single BLAS matrix-vector product over all
+    entries. A lookup hits when the cosine similarity to a cached query
+    reaches the threshold and the entry was stored under the same key (e.g.
+    the request context). Once full, the least recently used entry is
+    replaced.
+    """
+
+    def __init__(self, dimensions: int, max_entries: int = 1024, threshold: float = 0.95):
+        self.threshold = threshold
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._entries: List[Optional[Tuple[str, Any]]] = [None] * max_entries
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._clock = itertools.count(1)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _unit(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding: Sequence[float], key: str = "") -> Optional[Any]:
+        """Return the value cached for the most similar query, if close enough."""
+        if not self._size:
+            return None
+        similarities = self._vectors[:self._size] @ self._unit(embedding)
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        # Most similar first; usually there are no more than a few candidates
+        for index in candidates[np.argsort(similarities[candidates])[::-1]]:
+            entry_key, value = self._entries[index]
+            if entry_key == key:
+                self._last_used[index] = next(self._clock)
+                return value
+        return None
+
+    def put(self, embedding: Sequence[float], value: Any, key: str = "") -> None:
+        """Cache a value for a query embedding, evicting the LRU entry if full."""
+        if self._size < len(self._entries):
+            index = self._size
+            self._size += 1
+        else:
+            index = int(np.argmin(self._last_used))
+        self._vectors[index] = self._unit(embedding)
+        self._entries[index] = (key, value)
+        self._last_used[index] = next(self._clock)
@@ -16,7 +16,7 @@ create table if not exists tiled_docs (
   summary text not null,
   content text not null,
   metadata jsonb not null default '{}'::jsonb,
-  embedding vector(1536) not null,
+  embedding vector(512) not null,
   created_at timestamp with time zone default timezone('utc'::text, now()) not null,
   unique(url, chunk_number)
 );
@@ -38,14 +38,17 @@ returns table (
 language plpgsql
 as $$
 declare
-  query_embedding vector(1536);
+  query_embedding vector(512);
   match_count int;
   match_threshold float;
 begin
-  query_embedding := (params->>'query_embedding')::vector(1536);
+  query_embedding := (params->>'query_embedding')::vector(512);
   match_count := coalesce((params->>'match_count')::int, 5);
   match_threshold := coalesce((params->>'match_threshold')::float, 0.78);
 
+  -- HNSW candidate list size for this transaction; must be at least match_count
+  perform set_config('hnsw.ef_search', greatest(40, match_count)::text, true);
+
   return query
   select
     tiled_docs.id,
@@ -58,14 +61,15 @@ begin
     1 - (tiled_docs.embedding <=> query_embedding) as similarity
   from tiled_docs
   where 1 - (tiled_docs.embedding <=> query_embedding) > match_threshold
-  order by similarity desc
+  -- Order by the distance operator itself so the planner can use the index
+  order by tiled_docs.embedding <=> query_embedding
   limit match_count;
 end;
 $$;
 
 -- Create an index for faster similarity searches
-create index if not exists tiled_docs_embedding_idx on tiled_docs using ivfflat (embedding vector_cosine_ops)
-with (lists = 100);
+create index if not exists tiled_docs_embedding_idx on tiled_docs using hnsw (embedding vector_cosine_ops)
+with (m = 16, ef_construction = 64);
 
 -- Enable Row Level Security (RLS)
 alter table tiled_docs enable row level security;
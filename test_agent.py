@@ -1,4 +1,4 @@
-import requests
+import httpx
 import os
 from dotenv import load_dotenv
 
@@ -6,8 +6,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 def test_tiled_agent():
-    # API endpoint
-    url = "http://localhost:8000/api/ask"
+    # API base URL
+    base_url = "http://localhost:8000"
     
     # Headers with bearer token
     headers = {
@@ -28,8 +28,9 @@ def test_tiled_agent():
         "collaborative": False
     }
     
-    # Send request
-    response = requests.post(url, json=data, headers=headers)
+    # Send request over a pooled client; reuse it for any further queries
+    with httpx.Client(http2=True, base_url=base_url, headers=headers, timeout=60.0) as client:
+        response = client.post("/api/ask", json=data)
     
     # Print results
     if response.status_code == 200:
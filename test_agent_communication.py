@@ -53,6 +53,8 @@ async def test_agent_communication(custom_query: str = None):
         
     except Exception as e:
         print(f"❌ Error: {str(e)}")
+    finally:
+        await agent_comm.aclose()
 
 if __name__ == "__main__":
     # Get custom query from command line arguments if provided
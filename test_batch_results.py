@@ -0,0 +1,65 @@
+"""Tests for reading batch output, using a fake files client."""
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+
+from batch_results import batch_answers
+
+
+class FakeClient:
+    """Stands in for AsyncOpenAI; serves one output file."""
+
+    def __init__(self, lines):
+        self.content = b"\n".join(orjson.dumps(line) for line in lines)
+        self.requested = []
+        self.files = SimpleNamespace(content=self.file_content)
+
+    async def file_content(self, file_id):
+        self.requested.append(file_id)
+        return SimpleNamespace(content=self.content)
+
+
+def batch(total: int):
+    return SimpleNamespace(output_file_id="file-out", request_counts=SimpleNamespace(total=total))
+
+
+def answer(custom_id: str, content: str) -> dict:
+    body = {"choices": [{"message": {"content": content}}]}
+    return {"custom_id": custom_id, "response": {"status_code": 200, "body": body}}
+
+
+def test_answers_are_placed_by_custom_id():
+    client = FakeClient([answer("2", "third"), answer("0", "first"), answer("1", "second")])
+    answers = asyncio.run(batch_answers(client, batch(3)))
+    assert answers == [{"response": "first"}, {"response": "second"}, {"response": "third"}]
+    assert client.requested == ["file-out"]
+
+
+def test_error_bodies_become_errors():
+    error = {"message": "Context length exceeded", "type": "invalid_request_error"}
+    client = FakeClient([
+        answer("0", "ok"),
+        {"custom_id": "1", "response": {"status_code": 400, "body": {"error": error}}},
+        {"custom_id": "2", "response": None, "error": {"code": "server_error"}},
+    ])
+    answers = asyncio.run(batch_answers(client, batch(3)))
+    assert answers == [{"response": "ok"}, {"error": error}, {"error": {"code": "server_error"}}]
+
+
+def test_missing_lines_fill_the_total():
+    # Requests that failed outright are only in the error file
+    client = FakeClient([answer("1", "second")])
+    answers = asyncio.run(batch_answers(client, batch(3)))
+    assert answers == [
+        {"error": "Request failed"},
+        {"response": "second"},
+        {"error": "Request failed"},
+    ]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,116 @@
+"""Tests for the crawler's token-based chunker, using a stand-in tokenizer."""
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "scripts"))
+from chunking import iter_chunks
+
+
+class WordEncoding:
+    """Splits text like tiktoken's cl100k pattern: words take one leading
+    space, and punctuation absorbs the newlines after it ('.\\n\\n' is one
+    token). Same encode() and decode_with_offsets() as tiktoken, without
+    downloading a vocabulary."""
+
+    PATTERN = re.compile(r' ?\w+| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+')
+
+    def encode(self, text, disallowed_special=()):
+        return self.PATTERN.findall(text)
+
+    def decode_with_offsets(self, tokens):
+        text = "".join(tokens)
+        starts, position = [], 0
+        for token in tokens:
+            starts.append(position)
+            position += len(token)
+        return text, starts
+
+
+ENCODING = WordEncoding()
+
+
+def token_count(text: str) -> int:
+    return len(ENCODING.encode(text))
+
+
+def prose(sentences: int, start: int = 0) -> str:
+    return " ".join(f"Sentence {n} has some words in it." for n in range(start, start + sentences))
+
+
+def test_empty_input():
+    assert list(iter_chunks("", ENCODING)) == []
+    assert list(iter_chunks("   \n\n  ", ENCODING)) == []
+
+
+def test_short_text_is_one_chunk():
+    assert list(iter_chunks("  A short page.  ", ENCODING)) == ["A short page."]
+
+
+def test_chunks_stay_within_target():
+    text = "\n\n".join(prose(7, n * 7) for n in range(40))
+    chunks = list(iter_chunks(text, ENCODING, target_tokens=100, overlap=10))
+    assert len(chunks) > 1
+    assert all(token_count(chunk) <= 100 for chunk in chunks)
+
+
+def test_chunks_cover_text_in_order_with_overlap():
+    text = "\n\n".join(prose(7, n * 7) for n in range(40))
+    chunks = list(iter_chunks(text, ENCODING, target_tokens=100, overlap=10))
+    spans = []
+    for chunk in chunks:
+        start = text.find(chunk)
+        assert start >= 0
+        spans.append((start, start + len(chunk)))
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    for (start, end), (next_start, next_end) in zip(spans, spans[1:]):
+        # Each chunk moves forward and starts before the previous one ends
+        assert start < next_start < end < next_end
+
+
+def test_no_overlap_partitions_text():
+    text = prose(200)
+    chunks = list(iter_chunks(text, ENCODING, target_tokens=50, overlap=0))
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_prefers_paragraph_break():
+    text = "\n\n".join(prose(4, n * 4) for n in range(10))
+    for chunk in list(iter_chunks(text, ENCODING, target_tokens=60, overlap=0))[:-1]:
+        assert text[text.find(chunk) + len(chunk):].startswith("\n\n")
+
+
+def test_prefers_code_block_over_paragraph():
+    code = "```python\nlayer = map.layers[0]\n```"
+    text = prose(3) + "\n\n" + prose(3, 3) + "\n\n" + code + "\n\n" + prose(20, 6)
+    first = next(iter_chunks(text, ENCODING, target_tokens=60, overlap=0))
+    # Past 30% of the window, the chunk ends right before the code block
+    assert text[len(first):].lstrip().startswith("```")
+
+
+def test_paragraph_cut_keeps_closing_punctuation():
+    assert ".\n\n" in ENCODING.encode("Ends here.\n\nNext one.")
+    text = "\n\n".join(prose(4, n * 4) for n in range(10))
+    chunks = list(iter_chunks(text, ENCODING, target_tokens=60, overlap=10))
+    assert all(chunk.endswith(".") for chunk in chunks)
+    assert not any(chunk.startswith(".") for chunk in chunks)
+
+
+def test_falls_back_to_sentence_break():
+    text = prose(50)
+    for chunk in list(iter_chunks(text, ENCODING, target_tokens=40, overlap=0))[:-1]:
+        assert chunk.endswith(".")
+
+
+def test_always_makes_progress():
+    # No break points at all, and an overlap as large as the window
+    text = " ".join(f"word{n}" for n in range(300))
+    chunks = list(iter_chunks(text, ENCODING, target_tokens=20, overlap=20))
+    assert chunks[-1].endswith("word299")
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,159 @@
+"""Tests for EmbeddingBatcher, using a fake embeddings client."""
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from embedding_batcher import EmbeddingBatcher
+
+
+def api_error(error_class, status_code: int) -> openai.APIStatusError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    response = httpx.Response(status_code, request=request)
+    return error_class("error", response=response, body=None)
+
+
+class FakeClient:
+    """Stands in for AsyncOpenAI; embeds each text as [len(text)]."""
+
+    def __init__(self, error_for=None, drop_last=False, delay=0.0):
+        self.calls = []
+        self.error_for = error_for or (lambda texts: None)
+        self.drop_last = drop_last
+        self.delay = delay
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    async def create(self, model, input, dimensions):
+        self.calls.append(list(input))
+        await asyncio.sleep(self.delay)
+        error = self.error_for(input)
+        if error:
+            raise error
+        data = [SimpleNamespace(index=i, embedding=[len(text)]) for i, text in enumerate(input)]
+        if self.drop_last:
+            data = data[:-1]
+        # The API doesn't promise order; results are matched by index
+        return SimpleNamespace(data=data[::-1])
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_coalesces_concurrent_requests():
+    client = FakeClient()
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.gather(*(batcher.submit("x" * n) for n in range(1, 6)))
+
+    assert run(main()) == [[1], [2], [3], [4], [5]]
+    assert len(client.calls) == 1
+
+
+def test_splits_at_max_batch():
+    client = FakeClient()
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512, max_batch=2)
+        return await asyncio.gather(*(batcher.submit("x" * n) for n in range(1, 6)))
+
+    assert run(main()) == [[1], [2], [3], [4], [5]]
+    assert [len(call) for call in client.calls] == [2, 2, 1]
+
+
+def test_server_error_fails_whole_batch():
+    client = FakeClient(error_for=lambda texts: api_error(openai.InternalServerError, 500))
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+    results = run(main())
+    assert all(isinstance(result, openai.APIStatusError) for result in results)
+    assert len(client.calls) == 1
+
+
+def test_rate_limit_is_not_split():
+    client = FakeClient(error_for=lambda texts: api_error(openai.RateLimitError, 429))
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+    results = run(main())
+    assert all(isinstance(result, openai.APIStatusError) for result in results)
+    assert len(client.calls) == 1
+
+
+def test_auth_error_is_not_split():
+    client = FakeClient(error_for=lambda texts: api_error(openai.AuthenticationError, 401))
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+    results = run(main())
+    assert all(isinstance(result, openai.AuthenticationError) for result in results)
+    assert len(client.calls) == 1
+
+
+def test_bad_input_only_fails_its_own_caller():
+    client = FakeClient(
+        error_for=lambda texts: api_error(openai.BadRequestError, 400) if "" in texts else None
+    )
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.gather(
+            batcher.submit("a"),
+            batcher.submit(""),
+            batcher.submit("ccc"),
+            return_exceptions=True
+        )
+
+    ok, bad, also_ok = run(main())
+    assert ok == [1] and also_ok == [3]
+    assert isinstance(bad, openai.BadRequestError)
+    # One failed batch, then each text on its own
+    assert client.calls[0] == ["a", "", "ccc"]
+    assert sorted(client.calls[1:]) == [[""], ["a"], ["ccc"]]
+
+
+def test_missing_result_fails_instead_of_hanging():
+    client = FakeClient(drop_last=True)
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        return await asyncio.wait_for(
+            asyncio.gather(batcher.submit("a"), batcher.submit("bb"), return_exceptions=True),
+            timeout=1.0
+        )
+
+    first, second = run(main())
+    assert first == [1]
+    assert isinstance(second, RuntimeError)
+
+
+def test_cancelled_request_does_not_break_batch():
+    client = FakeClient(delay=0.05)
+
+    async def main():
+        batcher = EmbeddingBatcher(client, "model", 512)
+        cancelled = asyncio.create_task(batcher.submit("a"))
+        kept = asyncio.create_task(batcher.submit("bb"))
+        # Cancel while the batch call is in flight
+        await asyncio.sleep(0.02)
+        cancelled.cancel()
+        return await kept, cancelled.cancelled()
+
+    assert run(main()) == ([2], True)
+    assert client.calls == [["a", "bb"]]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,71 @@
+"""Tests for AgentCommunication._retry_request, with no network."""
+import asyncio
+from unittest.mock import patch
+
+import httpx
+
+from agent_communication import AgentCommunication
+
+URL = "https://agent.example/api/ask"
+
+
+def run_with_statuses(statuses):
+    """Send one request through a transport answering with the given statuses.
+
+    Returns the response or raised error, the number of requests sent and
+    the backoff delays slept between them.
+    """
+    remaining = list(statuses)
+    sent = []
+    delays = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request)
+        return httpx.Response(remaining.pop(0), json={"response": "ok"})
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    async def main():
+        agent = AgentCommunication()
+        await agent.aclose()
+        agent._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with agent:
+            try:
+                return await agent._retry_request("POST", URL, json={"query": "q"})
+            except Exception as e:
+                return e
+
+    with patch("agent_communication.asyncio.sleep", fake_sleep):
+        result = asyncio.run(main())
+    return result, len(sent), delays
+
+
+def test_retries_server_errors_until_success():
+    result, sent, delays = run_with_statuses([503, 503, 200])
+    assert isinstance(result, httpx.Response) and result.status_code == 200
+    assert sent == 3
+    assert delays == [0.5, 1.0]
+
+
+def test_client_error_is_not_retried():
+    result, sent, delays = run_with_statuses([404])
+    assert isinstance(result, httpx.HTTPStatusError)
+    assert result.response.status_code == 404
+    assert sent == 1
+    assert delays == []
+
+
+def test_gives_up_after_three_server_errors():
+    result, sent, delays = run_with_statuses([500, 500, 500])
+    assert isinstance(result, httpx.HTTPStatusError)
+    assert result.response.status_code == 500
+    assert sent == 3
+    assert delays == [0.5, 1.0]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -0,0 +1,72 @@
+"""Tests for the in-memory semantic answer cache."""
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+DIMENSIONS = 512
+rng = np.random.default_rng(0)
+
+
+def random_unit() -> np.ndarray:
+    vector = rng.standard_normal(DIMENSIONS).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def near(vector: np.ndarray, noise: float = 0.01) -> np.ndarray:
+    """A vector with cosine similarity close to 1 to the given one."""
+    return vector + noise * rng.standard_normal(DIMENSIONS).astype(np.float32)
+
+
+def test_hits_near_duplicate_and_misses_unrelated():
+    cache = SemanticCache(DIMENSIONS)
+    query = random_unit()
+    cache.put(query, "answer")
+    assert cache.get(near(query)) == "answer"
+    assert cache.get(random_unit()) is None
+
+
+def test_empty_cache_and_zero_vector():
+    cache = SemanticCache(DIMENSIONS)
+    assert cache.get(random_unit()) is None
+    cache.put(np.zeros(DIMENSIONS), "zero")
+    assert cache.get(np.zeros(DIMENSIONS)) is None
+    assert cache.get(random_unit()) is None
+
+
+def test_key_must_match():
+    cache = SemanticCache(DIMENSIONS)
+    query = random_unit()
+    cache.put(query, "no context")
+    cache.put(query, "with context", key="RPG map")
+    assert cache.get(query) == "no context"
+    assert cache.get(query, key="RPG map") == "with context"
+    assert cache.get(query, key="other context") is None
+
+
+def test_most_similar_entry_wins():
+    cache = SemanticCache(DIMENSIONS, threshold=0.9)
+    query = random_unit()
+    cache.put(near(query, noise=0.02), "farther")
+    cache.put(near(query, noise=0.005), "closer")
+    assert cache.get(query) == "closer"
+
+
+def test_evicts_least_recently_used():
+    cache = SemanticCache(DIMENSIONS, max_entries=2)
+    a, b, c = random_unit(), random_unit(), random_unit()
+    cache.put(a, "a")
+    cache.put(b, "b")
+    # Reading a makes b the least recently used entry
+    assert cache.get(a) == "a"
+    cache.put(c, "c")
+    assert len(cache) == 2
+    assert cache.get(a) == "a"
+    assert cache.get(b) is None
+    assert cache.get(c) == "c"
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")
@@ -1,20 +1,35 @@
-from typing import List, Optional, Dict, Any
+from typing import Annotated, List, Optional, Dict, Any, Tuple
 from fastapi import FastAPI, HTTPException, Security, Depends
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, NotFoundError
+import asyncio
+import hmac
+import httpx
 import os
+import orjson
 from pydantic_ai import Agent
+from pydantic_ai.models.openai import OpenAIModel
+from batch_results import batch_answers
+from embedding_batcher import EmbeddingBatcher
+from semantic_cache import SemanticCache
 
 # Load environment variables
 load_dotenv()
 
+# Bearer token clients must present; read once at startup
+API_BEARER_TOKEN = os.getenv("API_BEARER_TOKEN")
+if not API_BEARER_TOKEN:
+    raise RuntimeError("API_BEARER_TOKEN environment variable not set")
+_EXPECTED_TOKEN = API_BEARER_TOKEN.encode()
+
 # Initialize FastAPI app
 app = FastAPI(title="Tiled Documentation Agent API",
-             description="API for querying Tiled documentation")
+             description="API for querying Tiled documentation",
+             default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 app.add_middleware(
@@ -26,14 +41,70 @@ app.add_middleware(
 )
 
 # Initialize clients
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-supabase: Client = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
+# One HTTP/2 pool shared by the OpenAI and Supabase calls, so requests
+# reuse warm connections instead of opening new ones under load
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+)
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=3,  # SDK backs off exponentially on 429s, 5xx and connection errors
+    http_client=http_client
 )
+# Supabase's PostgREST API, called directly so retrieval stays fully async
+SUPABASE_REST_URL = f"{os.getenv('SUPABASE_URL')}/rest/v1"
+_supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
+SUPABASE_HEADERS = {
+    "apikey": _supabase_key,
+    "Authorization": f"Bearer {_supabase_key}",
+    "Content-Type": "application/json"
+}
+
+# Read once at import, like the rest of the configuration
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4")
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512  # Must match tiled_docs.embedding in supabase/setup.sql
+# text-embedding-3 similarities run lower than ada-002's; the SQL default
+# of 0.78 would filter out nearly every chunk
+MATCH_THRESHOLD = 0.3
+
+# Concurrent requests share embedding calls
+embedding_batcher = EmbeddingBatcher(openai_client, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+
+# Answers for recent near-identical questions, as (response, source_documents)
+answer_cache = SemanticCache(EMBEDDING_DIMENSIONS, max_entries=1024, threshold=0.95)
+
+SYSTEM_PROMPT = """You are an expert at Tiled Map Editor and its Python library.
+Your role is to help developers understand and use Tiled effectively for creating game maps.
+
+When responding to questions:
+1. Be concise and direct
+2. Provide code examples when relevant
+3. Reference official documentation
+4. Explain concepts in a way that's easy for developers to understand
+5. If you're not sure about something, say so rather than making assumptions
+
+Remember to:
+- Focus on practical, working solutions
+- Highlight best practices for map creation
+- Consider performance implications
+- Mention any relevant plugins or extensions
+- Point out common pitfalls to avoid"""
+
+# Built once at import; runs keep no state on the agent, so requests can share it
+agent = Agent(
+    model=OpenAIModel(LLM_MODEL, openai_client=openai_client),
+    system_prompt=SYSTEM_PROMPT
+)
+
+# Well under the embedding model's 8191-token input limit, even for text
+# that tokenizes at two tokens per character
+MAX_QUERY_CHARS = 4000
 
 class AgentRequest(BaseModel):
-    query: str
+    query: str = Field(min_length=1, max_length=MAX_QUERY_CHARS)
     user_id: str = "default"
     session_id: str = "default"
     context: str = ""
@@ -44,21 +115,97 @@ class AgentResponse(BaseModel):
     source_documents: List[Dict[str, Any]] = []
     collaborative_insights: Optional[Dict[str, Any]] = None
 
+# Far below the Batch API's 50,000 requests per input file; retrieval for
+# every query still runs before the batch is submitted
+MAX_BATCH_QUERIES = 1000
+
+class BatchRequest(BaseModel):
+    queries: List[Annotated[str, Field(min_length=1, max_length=MAX_QUERY_CHARS)]] = Field(
+        min_length=1,
+        max_length=MAX_BATCH_QUERIES
+    )
+    context: str = ""
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> bool:
-    """Verify the bearer token against environment variable."""
-    expected_token = os.getenv("API_BEARER_TOKEN")
-    if not expected_token:
-        raise HTTPException(
-            status_code=500,
-            detail="API_BEARER_TOKEN environment variable not set"
-        )
-    if credentials.credentials != expected_token:
+    """Verify the bearer token against API_BEARER_TOKEN in constant time."""
+    if not hmac.compare_digest(credentials.credentials.encode(), _EXPECTED_TOKEN):
         raise HTTPException(
             status_code=401,
             detail="Invalid authentication token"
         )
     return True
 
+async def get_embedding(text: str) -> List[float]:
+    """Embed text with the model and size used for the stored chunks."""
+    return await embedding_batcher.submit(text)
+
+async def get_relevant_docs(query_embedding: List[float], match_count: int = 5) -> List[Dict[str, Any]]:
+    """Retrieve the documentation chunks most similar to a query embedding."""
+    response = await http_client.post(
+        f"{SUPABASE_REST_URL}/rpc/match_tiled_docs",
+        headers=SUPABASE_HEADERS,
+        content=orjson.dumps({
+            "params": {
+                "query_embedding": query_embedding,
+                "match_count": match_count,
+                "match_threshold": MATCH_THRESHOLD
+            }
+        })
+    )
+    response.raise_for_status()
+    return response.json()
+
+def build_query(request: AgentRequest, docs: List[Dict[str, Any]]) -> str:
+    """Prefix the question with the retrieved docs and any request context."""
+    query = f"{request.context}\n\nQuestion: {request.query}" if request.context else request.query
+    if not docs:
+        return query
+    context = "\n\n---\n\n".join(
+        f"# {doc['title']}\n\n{doc['content']}\n\nSource: {doc['url']}"
+        for doc in docs
+    )
+    return f"Relevant Tiled documentation:\n\n{context}\n\n{query}"
+
+def source_documents(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Describe the retrieved docs for the response, without their content."""
+    return [
+        {
+            "url": doc["url"],
+            "title": doc["title"],
+            "summary": doc["summary"],
+            "similarity": doc["similarity"]
+        }
+        for doc in docs
+    ]
+
+def sse_event(data: Dict[str, Any]) -> bytes:
+    """Encode a payload as a server-sent events data frame."""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+async def answer_query(request: AgentRequest) -> Tuple[str, List[Dict[str, Any]]]:
+    """Answer a request from the docs, returning the answer and its sources."""
+    query_embedding = await get_embedding(request.query)
+    
+    # A near-identical question with the same context was answered recently
+    cached = answer_cache.get(query_embedding, key=request.context)
+    if cached:
+        return cached
+    
+    # Retrieve first so the answer is grounded in the docs
+    docs = await get_relevant_docs(query_embedding)
+    
+    # Run the agent
+    result = await agent.run(build_query(request, docs))
+    
+    sources = source_documents(docs)
+    answer_cache.put(query_embedding, (result.data, sources), key=request.context)
+    return result.data, sources
+
+@app.on_event("shutdown")
+async def close_clients():
+    """Close the shared connection pool."""
+    await http_client.aclose()
+
 @app.get("/")
 async def root():
     """Root endpoint returning API information."""
@@ -68,7 +215,7 @@ async def root():
         "status": "operational"
     }
 
-@app.post("/api/ask")
+@app.post("/api/ask", response_model=AgentResponse)
 async def tiled_expert_endpoint(
     request: AgentRequest,
     authenticated: bool = Depends(verify_token)
@@ -78,43 +225,152 @@ async def tiled_expert_endpoint(
     Requires bearer token authentication.
     """
     try:
-        # Initialize the agent with OpenAI model
-        agent = Agent(
-            model="openai:gpt-4",
-            system_prompt="""You are an expert at Tiled Map Editor and its Python library.
-Your role is to help developers understand and use Tiled effectively for creating game maps.
+        response, sources = await answer_query(request)
+        
+        # Returning the response directly skips FastAPI's jsonable_encoder
+        # pass; the payload is plain dicts and strings, which orjson handles
+        return ORJSONResponse(AgentResponse(
+            response=response,
+            source_documents=sources,
+            collaborative_insights=None
+        ).model_dump())
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-When responding to questions:
-1. Be concise and direct
-2. Provide code examples when relevant
-3. Reference official documentation
-4. Explain concepts in a way that's easy for developers to understand
-5. If you're not sure about something, say so rather than making assumptions
+@app.post("/api/ask/stream")
+async def tiled_expert_stream_endpoint(
+    request: AgentRequest,
+    authenticated: bool = Depends(verify_token)
+):
+    """
+    Streaming variant of /api/ask.
+    Sends the answer as server-sent events while it is generated:
+    {"token": ...} frames, then {"done": true, "sources": [...]}.
+    Requires bearer token authentication.
+    """
+    # Retrieve before streaming starts, so failures still get a proper status
+    try:
+        query_embedding = await get_embedding(request.query)
+        cached = answer_cache.get(query_embedding, key=request.context)
+        docs = [] if cached else await get_relevant_docs(query_embedding)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def cached_stream():
+        response, sources = cached
+        yield sse_event({"token": response})
+        yield sse_event({"done": True, "sources": sources})
+    
+    async def event_stream():
+        deltas = []
+        try:
+            async with agent.run_stream(build_query(request, docs)) as result:
+                # No debouncing, so each token goes out as soon as it arrives
+                async for delta in result.stream_text(delta=True, debounce_by=None):
+                    deltas.append(delta)
+                    yield sse_event({"token": delta})
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            yield sse_event({"error": str(e)})
+            return
+        sources = source_documents(docs)
+        answer_cache.put(query_embedding, ("".join(deltas), sources), key=request.context)
+        yield sse_event({"done": True, "sources": sources})
+    
+    return StreamingResponse(
+        cached_stream() if cached else event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-Remember to:
-- Focus on practical, working solutions
-- Highlight best practices for map creation
-- Consider performance implications
-- Mention any relevant plugins or extensions
-- Point out common pitfalls to avoid"""
+# Tags our batch jobs, so the status endpoint only reports those
+BATCH_SOURCE = "tiled-agent-api"
+
+# Retrievals in flight across all batch submissions, so a large batch
+# doesn't flood the embedding API or the pool /api/ask depends on
+batch_retrieval_sem = asyncio.Semaphore(8)
+
+async def batch_line(index: int, request: AgentRequest) -> bytes:
+    """Build one Batch API input line answering a request from the docs."""
+    async with batch_retrieval_sem:
+        docs = await get_relevant_docs(await get_embedding(request.query))
+    return orjson.dumps({
+        "custom_id": str(index),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": LLM_MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": build_query(request, docs)}
+            ]
+        }
+    })
+
+@app.post("/api/ask/batch")
+async def submit_batch_endpoint(
+    request: BatchRequest,
+    authenticated: bool = Depends(verify_token)
+):
+    """
+    Submit many queries as one OpenAI batch job, for bulk and offline use.
+    Answers arrive within 24 hours at half the cost of /api/ask.
+    Requires bearer token authentication.
+    """
+    try:
+        # Retrieval still happens now, so the batch prompts match /api/ask
+        lines = await asyncio.gather(*(
+            batch_line(index, AgentRequest(query=query, context=request.context))
+            for index, query in enumerate(request.queries)
+        ))
+        input_file = await openai_client.files.create(
+            file=("batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
         )
-        
-        # Include context in the query if provided
-        full_query = f"{request.context}\n\nQuestion: {request.query}" if request.context else request.query
-        
-        # Run the agent
-        result = await agent.run(full_query)
-        
-        return AgentResponse(
-            response=result.data,
-            source_documents=[],  # TODO: Add relevant source documents
-            collaborative_insights=None
+        batch = await openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"source": BATCH_SOURCE}
         )
+        return {"batch_id": batch.id, "status": batch.status}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/ask/batch/{batch_id}")
+async def batch_status_endpoint(
+    batch_id: str,
+    authenticated: bool = Depends(verify_token)
+):
+    """
+    Report a batch's status, with its answers once it has completed.
+    Answers are listed in the order the queries were submitted.
+    Requires bearer token authentication.
+    """
+    try:
+        batch = await openai_client.batches.retrieve(batch_id)
+        # Other jobs on the same OpenAI account aren't ours to show
+        if (batch.metadata or {}).get("source") != BATCH_SOURCE:
+            raise HTTPException(status_code=404, detail="Batch not found")
+        result: Dict[str, Any] = {"batch_id": batch.id, "status": batch.status}
+        if batch.status == "completed" and batch.output_file_id:
+            result["responses"] = await batch_answers(openai_client, batch)
+        return result
         
+    except HTTPException:
+        raise
+    except NotFoundError:
+        raise HTTPException(status_code=404, detail="Batch not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Same variable the uvicorn CLI (and so the Procfile) reads for --workers.
+    # Each worker keeps its own caches and connection pools.
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    # Workers need the app as an import string so each process can load it
+    uvicorn.run("tiled_ai_agent:app", host="0.0.0.0", port=port, workers=workers)